@@ -1,8 +1,15 @@
-import random
 import numpy as np
 import pandas as pd
 import plotly.express as px
-from tqdm.notebook import tqdm
+from numba import njit, prange
+from tqdm.auto import tqdm
+
+# Upper bound on the number of people paired per block of iterations whose randomness is drawn up
+# front, which keeps the pairing array to a few megabytes regardless of n
+_MAX_BLOCK_DRAWS = 2 ** 20
+# Below this many iterations per block, drawing up front is no faster than running each iteration
+# on its own, so large populations are run one iteration at a time
+_MIN_BLOCK_SIZE = 1024
 
 
 def plot_wealth(yard_sale, n):
@@ -11,25 +18,166 @@ def plot_wealth(yard_sale, n):
     :return: None
     """
     wealth = pd.DataFrame({'person': list(yard_sale[n].keys()),
-                           'wealth': list(yard_sale[n].values())})
+                           'wealth': np.fromiter(yard_sale[n].values(), dtype=np.float64,
+                                                 count=len(yard_sale[n]))})
     fig = px.bar(wealth, x='person', y='wealth')
     fig.show()
 
 
+@njit(cache=True)
+def _sale_step(w, pair_idx, rolls_u, win_percentage, chi, zeta, kappa):
+    """Runs a single iteration of the extended yard sale model on the wealth array in place.
+
+    Tax, loan, coin flip, exchange and repayment are fused into one compiled pass so that no
+    temporary arrays are allocated per iteration.
+
+    :param w: numpy array of wealth in cents, updated in place
+    :param pair_idx: numpy array of shape (n_people / 2, 2) with the positions of transacting
+        members in w
+    :param rolls_u: numpy array of uniform draws on [0, 1), one per pair
+    :param win_percentage: (float) Percentage of the poorer person's wealth that is exchanged
+    :param chi: (float) Wealth tax rate
+    :param zeta: (float) Bias in favour of the richer person
+    :param kappa: (float) Proportional to the amount of negative wealth a person can have
+    :return: None
+    """
+    n_people = w.shape[0]
+    avg_wealth = 0.
+    for i in range(n_people):
+        avg_wealth += w[i]
+    avg_wealth /= n_people
+
+    # People richer than the average pay the tax, which is shared equally by everyone else.
+    # Without a tax both passes leave wealth unchanged, so they are skipped.
+    if chi != 0:
+        rich_sum = 0
+        n_poor = 0
+        for i in range(n_people):
+            if w[i] > avg_wealth:
+                rich_sum += w[i]
+            else:
+                n_poor += 1
+        tax = np.floor(chi * rich_sum)
+        per_person_subsidy = round(tax / n_poor) if n_poor > 0 else 0
+        for i in range(n_people):
+            if w[i] > avg_wealth:
+                w[i] -= round(w[i] * chi)
+            else:
+                w[i] += per_person_subsidy
+
+    loan = kappa * avg_wealth
+    for k in range(pair_idx.shape[0]):
+        a = pair_idx[k, 0]
+        b = pair_idx[k, 1]
+
+        # On a tie the first person of the pair is treated as the poorer one
+        if w[a] <= w[b]:
+            poor, rich = a, b
+        else:
+            poor, rich = b, a
+
+        # The bias is defined on the wealth difference in dollars
+        bias = zeta * (w[rich] - w[poor]) / 100
+        exchange_amount = round((w[poor] + loan) * win_percentage)
+        if rolls_u[k] >= 0.5 / (1 + bias):
+            exchange_amount = -exchange_amount
+
+        # The loan is repaid in full, so only the exchanged cents change hands
+        w[poor] += exchange_amount
+        w[rich] -= exchange_amount
+
+
+@njit(cache=True)
+def _run_sale_steps(w, pair_idx, rolls_u, win_percentage, chi, zeta, kappa):
+    """Runs consecutive iterations of the extended yard sale model on the wealth array in place.
+
+    :param w: numpy array of wealth in cents, updated in place
+    :param pair_idx: numpy array of shape (n_iterations, n_people / 2, 2) with the positions of
+        transacting members in w for each iteration
+    :param rolls_u: numpy array of shape (n_iterations, n_people / 2) of uniform draws on [0, 1)
+    :param win_percentage: (float) Percentage of the poorer person's wealth that is exchanged
+    :param chi: (float) Wealth tax rate
+    :param zeta: (float) Bias in favour of the richer person
+    :param kappa: (float) Proportional to the amount of negative wealth a person can have
+    :return: None
+    """
+    for k in range(pair_idx.shape[0]):
+        _sale_step(w, pair_idx[k], rolls_u[k], win_percentage, chi, zeta, kappa)
+
+
+@njit(cache=True, parallel=True)
+def _batch_sale_step(w, pair_idx, rolls_u, win_percentage, chi, zeta, kappa):
+    """Runs a single iteration of independent extended yard sales in parallel.
+
+    :param w: numpy array of wealth in cents of shape (n_sales, n_people), updated in place
+    :param pair_idx: numpy array of shape (n_sales, n_people / 2, 2) with the positions of
+        transacting members in each row of w
+    :param rolls_u: numpy array of shape (n_sales, n_people / 2) of uniform draws on [0, 1)
+    :param win_percentage: (float) Percentage of the poorer person's wealth that is exchanged
+    :param chi: (float) Wealth tax rate
+    :param zeta: (float) Bias in favour of the richer person
+    :param kappa: (float) Proportional to the amount of negative wealth a person can have
+    :return: None
+    """
+    for r in prange(w.shape[0]):
+        _sale_step(w[r], pair_idx[r], rolls_u[r], win_percentage, chi, zeta, kappa)
+
+
 class Wealth:
-    """Stores the wealth of an even number of people as a dictionary.
+    """Stores the wealth of an even number of people in cents as a numpy array indexed by person.
 
         Args:
             start_wealth (dict): Wealth for an even number of people
 
         Attributes:
-            start_wealth (dict): Wealth for an even number of people
+            wealth (dict): Wealth for an even number of people, built from the wealth array
+                on access.
 
     """
     def __init__(self, start_wealth):
-        self._validate_wealth(start_wealth)
         self.wealth = start_wealth
 
+    @property
+    def wealth(self):
+        """Returns the wealth of each person as a dictionary of the form {person_id: wealth}.
+
+        :return: dictionary
+        """
+        return dict(zip(self._ids, (self._w / 100).tolist()))
+
+    @wealth.setter
+    def wealth(self, wealth):
+        """Validates the wealth dictionary and stores the person ids as a tuple and their wealth
+        as a numpy array of whole cents, so that money moves exactly between people.
+
+        :param wealth: dictionary
+        :return: None
+        """
+        self._validate_wealth(wealth)
+        self._ids = tuple(wealth)
+        wealth_values = np.fromiter(wealth.values(), dtype=np.float64, count=len(wealth))
+        self._w = np.round(wealth_values * 100).astype(np.int64)
+        self._on_wealth_assigned()
+
+    def _on_wealth_assigned(self):
+        """Rebuilds the state derived from the wealth array after the wealth attribute is
+        assigned: the ranks 1..n used to weight the sorted wealth in the gini coefficient and the
+        cached sorted wealth and lorenz curve.
+
+        :return: None
+        """
+        self._ranks = np.arange(1, self._w.size + 1, dtype=np.float64)
+        self._invalidate_cache()
+
+    def _invalidate_cache(self):
+        """Clears the sorted wealth and lorenz curve cached from the wealth array. Needs to be
+        called whenever the wealth array changes.
+
+        :return: None
+        """
+        self._sorted_cache = None
+        self._lorenz_cache = None
+
     @staticmethod
     def _validate_wealth(wealth):
         """Validates the wealth dictionary.
@@ -40,17 +188,19 @@ class Wealth:
         if not isinstance(wealth, dict):
             raise Exception('start_wealth needs to be a dictionary')
 
-        if len(wealth.keys()) % 2 != 0 or len(wealth.keys()) == 0:
+        if len(wealth) % 2 != 0 or len(wealth) == 0:
             raise Exception('start_wealth needs an even number of people')
 
     def sort_wealth(self):
-        """Returns the wealth attribute's values as a sorted numpy array.
+        """Returns the wealth attribute's values as a sorted numpy array. The array is cached until
+        the wealth changes and is therefore read-only.
 
         :return: numpy array
         """
-        wealth_values = list(self.wealth.values())
-        sorted_wealth = np.sort(wealth_values)
-        return sorted_wealth
+        if self._sorted_cache is None:
+            self._sorted_cache = np.sort(self._w) / 100
+            self._sorted_cache.flags.writeable = False
+        return self._sorted_cache
 
     def calc_gini(self):
         """Returns the gini coefficient of the wealth distribution based on the values of the
@@ -59,11 +209,11 @@ class Wealth:
         :return: float
         """
         sorted_wealth = self.sort_wealth()
-        n = len(self.wealth.keys())
+        n = sorted_wealth.size
         coef = 2. / n
         const = (n + 1.) / n
-        weighted_sum = sum([(i + 1) * yi for i, yi in enumerate(sorted_wealth)])
-        gini = coef * weighted_sum / np.sum(sorted_wealth) - const
+        weighted_sum = np.dot(self._ranks, sorted_wealth)
+        gini = coef * weighted_sum / sorted_wealth.sum() - const
         return gini
 
     def plot_lorenz_curve(self):
@@ -71,11 +221,15 @@ class Wealth:
 
         :return: None
         """
-        sorted_wealth = self.sort_wealth()
-        wealth_values_lorenz = np.cumsum(sorted_wealth) / np.sum(sorted_wealth)
-        wealth_values_lorenz = np.insert(wealth_values_lorenz, 0, 0)
+        if self._lorenz_cache is None:
+            sorted_wealth = self.sort_wealth()
+            self._lorenz_cache = np.empty(sorted_wealth.size + 1)
+            self._lorenz_cache[0] = 0
+            np.cumsum(sorted_wealth, out=self._lorenz_cache[1:])
+            self._lorenz_cache[1:] /= self._lorenz_cache[-1]
+        wealth_values_lorenz = self._lorenz_cache
         wealth_df = pd.DataFrame(
-            {'x': np.arange(wealth_values_lorenz.size) / (wealth_values_lorenz.size - 1),
+            {'x': np.linspace(0, 1, wealth_values_lorenz.size),
              'y': wealth_values_lorenz})
         fig = px.scatter(wealth_df, x='x', y='y')
         fig.add_shape(type='line', x0=0, x1=1, y0=0, y1=1, line_dash='dash', line_color='#C3C3C3')
@@ -140,130 +294,104 @@ class ExtendedYardSale(Wealth):
         self.zeta = zeta
         self.kappa = kappa
         self.n = n
-        self._n_people = len(self.wealth.keys())
-        random.seed(seed)
-
-    def _update_average_wealth(self):
-        """Calculates the average wealth of all people in the yard sale and updates the
-        _avg_wealth attribute."""
-        self._avg_wealth = np.mean(list(self.wealth.values()))
-
-    def _pay_tax(self):
-        """Updates the wealth attribute in the following way:
-        - People richer than the average wealth pay a flat wealth tax proportional
-          to the chi attribute
-        - People poorer than the average equally share the tax paid by the richer people
-        """
-        rich = {p: w for p, w in self.wealth.items() if w > self._avg_wealth}
-        poor = {p: w for p, w in self.wealth.items() if w <= self._avg_wealth}
+        self._rng = np.random.Generator(np.random.PCG64(seed))
 
-        tax = self.chi * np.sum(list(rich.values()))
-        tax = (tax // 0.01) / 100
+    def _on_wealth_assigned(self):
+        """Rebuilds the state derived from the wealth array after the wealth attribute is
+        assigned, including the number of people, the positions shuffled into pairs and the
+        starting wealth of run_multiple_sales.
 
-        if len(poor.keys()) > 0:
-            per_person_subsidy = tax / len(poor.keys())
-            poor = {p: (w + per_person_subsidy).round(2) for p, w in poor.items()}
+        :return: None
+        """
+        super()._on_wealth_assigned()
+        self._n_people = self._w.size
+        self._start_w = self._w.copy()
+        self._people = np.arange(self._n_people)
 
-        if len(rich.keys()) > 0:
-            rich = {p: (w - (w * self.chi)).round(2) for p, w in rich.items()}
+    def _pair_people(self):
+        """Returns an array of shape (n_people / 2, 2) with the positions of transacting members in
+        the wealth array. Each row represents a pair of people that will transact.
 
-        self.wealth = {**rich, **poor}
+        The positions are shuffled in place, so the returned array is only valid until the next
+        call.
 
-    def _loan_S(self):
-        """Updates the wealth attribute for all people by providing a loan proportional to
-        the attribute kappa before the transaction.
+        :return: numpy array
         """
-        self.wealth = {p: (w + (self.kappa * self._avg_wealth)).round(2) for p, w in self.wealth.items()}
+        self._rng.shuffle(self._people)
+        pair_idx = self._people.reshape(-1, 2)
+        return pair_idx
+
+    def perform_sale(self):
+        """Runs a single iteration of the extended yard sale model and updates the wealth attribute.
 
-    def _collect_S(self):
-        """Updates the wealth attribute for all people by paying back the loan after
-        the transaction.
+        :return: None
         """
-        self.wealth = {p: (w - (self.kappa * self._avg_wealth)).round(2) for p, w in self.wealth.items()}
+        pair_idx = self._pair_people()
+        rolls_u = self._rng.random(pair_idx.shape[0], dtype=np.float32)
+        _sale_step(self._w, pair_idx, rolls_u, self.win_percentage, self.chi, self.zeta, self.kappa)
+        self._invalidate_cache()
 
-    def _pair_people(self):
-        """Returns a list of dictionaries with transacting members.
-        Each element of the list represents a pair of people that will transact.
+    def _draw_sales(self, n_iter):
+        """Returns the pairings and coin flips of n_iter iterations of the extended yard sale model.
 
-        :return: object
-        """
-        people = list(self.wealth.keys())
-        pair_ids = np.array(random.sample(people, self._n_people)).reshape(-1, 2)
-        pair_wealths = []
-        for p in pair_ids:
-            pair_wealth = {k: self.wealth[k] for k in p}
-            pair_wealths.append(pair_wealth)
-        return pair_wealths
-
-    def _roll_dice(self, pair_wealths):
-        """Determine the winner of the transaction for all pairs.
-
-        Include the bias that gives the wealthier person the advantage.
-        Let 0 be a win for the richer person and 1 for the poorer person.
-
-        :param pair_wealths: list of dictionaries
-        :return: list
-        """
-        dice_rolls = []
-        for p in pair_wealths:
-            wealth_values = list(p.values())
-            wealth_difference = abs(wealth_values[0] - wealth_values[1])
-            bias = self.zeta * wealth_difference
-            weights = [(0.5 + bias) / (1 + bias), 0.5 / (1 + bias)]
-            dice_rolls.append(random.choices(population=[0, 1], weights=weights)[0])
-        return dice_rolls
-
-    def _exchange_wealth(self, wealth_permutation, dice_rolls):
-        """Updates the wealth attribute by moving money from the loser to the winner.
-
-        :param wealth_permutation: dictionary of dictionaries of form:
-            {pair_id: {person_id: wealth}}
-        :param dice_rolls: list of dice rolls
-        :return: None
+        :param n_iter: (int) The number of iterations
+        :return: tuple of numpy arrays of shape (n_iter, n_people / 2, 2) and (n_iter, n_people / 2)
         """
-        wealth = {}
-        for pair, roll in zip(wealth_permutation, dice_rolls):
-            pair_values = list(pair.values())
-            pair_keys = list(pair.keys())
-            exchange_amount = min(pair_values) * self.win_percentage
-            if pair_values[0] == pair_values[1]:
-                poor = pair_keys[0]
-                rich = pair_keys[1]
-            else:
-                poor = min(pair, key=pair.get)
-                rich = max(pair, key=pair.get)
-            wealth[poor] = (pair[poor] + ((2 * roll - 1) * exchange_amount)).round(2)
-            wealth[rich] = (pair[rich] + ((1 - 2 * roll) * exchange_amount)).round(2)
-        self.wealth = wealth
+        people = np.tile(np.arange(self._n_people), (n_iter, 1))
+        self._rng.permuted(people, axis=1, out=people)
+        pair_idx = people.reshape(n_iter, -1, 2)
+        rolls_u = self._rng.random(pair_idx.shape[:2], dtype=np.float32)
+        return pair_idx, rolls_u
 
-    def perform_sale(self):
-        """Runs a single iteration of the extended yard sale model and updates the wealth attribute.
+    def _perform_sales(self, stop_every):
+        """Runs n iterations of the extended yard sale model and updates the wealth attribute.
 
-        :return: None
+        The pairings and coin flips are drawn up front for blocks of iterations, which are then run
+        in a single compiled loop. Blocks have a fixed size so that the random draws, and therefore
+        the result, do not depend on stop_every.
+
+        :param stop_every: (int) Pauses the run after every multiple of this many iterations
+        :return: generator of the number of iterations completed at each pause
         """
-        self._update_average_wealth()
-        self._pay_tax()
-        self._loan_S()
-        wealth_permutation = self._pair_people()
-        dice_rolls = self._roll_dice(wealth_permutation)
-        self._exchange_wealth(wealth_permutation, dice_rolls)
-        self._collect_S()
-
-    def run_yard_sale(self, plot_n=1000, plot=True):
+        block_size = _MAX_BLOCK_DRAWS // self._n_people
+        i = 0
+        while i < self.n:
+            if block_size < _MIN_BLOCK_SIZE:
+                self.perform_sale()
+                i += 1
+                yield i
+                continue
+
+            pair_idx, rolls_u = self._draw_sales(min(block_size, self.n - i))
+            start = 0
+            while start < pair_idx.shape[0]:
+                end = min(pair_idx.shape[0], start + stop_every - i % stop_every)
+                _run_sale_steps(self._w, pair_idx[start:end], rolls_u[start:end],
+                                self.win_percentage, self.chi, self.zeta, self.kappa)
+                self._invalidate_cache()
+                i += end - start
+                start = end
+                yield i
+
+    def run_yard_sale(self, plot_n=1000, plot=True, show_progress=True):
         """Runs multiple iterations of the extended yard sale model.
 
         :param plot_n: (int) The number of iterations that need to elapse before plotting the wealth
             distribution. Default to 1000.
         :param plot: (booelan) If True, plots are returned. Default to True.
+        :param show_progress: (boolean) If True, shows a progress bar. Default to True.
         :return: None
         """
         if plot & (plot_n > self.n):
             raise Exception('plot_n needs to be lower than n')
         yard_sale = {}
-        for i in tqdm(range(1, self.n+1)):
-            self.perform_sale()
-            if plot & (i % plot_n == 0):
-                yard_sale[i] = self.wealth
+        n_done = 0
+        with tqdm(total=self.n, disable=not show_progress, mininterval=0.5) as progress:
+            for i in self._perform_sales(plot_n if plot else self.n):
+                progress.update(i - n_done)
+                n_done = i
+                if plot & (i % plot_n == 0):
+                    yard_sale[i] = self.wealth
         if plot:
             return yard_sale
 
@@ -273,5 +401,24 @@ class ExtendedYardSale(Wealth):
     def _get_sale_stats(self):
         pass
 
-    def run_multiple_sales(self):
-        pass
+    def run_multiple_sales(self, n_sales=100, show_progress=True):
+        """Runs independent extended yard sales of n iterations each from the starting wealth, which
+        is the wealth given at initialization or last assigned to the wealth attribute.
+
+        All sales are advanced together, one iteration at a time, on a 2-D wealth array. The wealth
+        attribute is left unchanged.
+
+        :param n_sales: (int) The number of independent yard sales. Default to 100.
+        :param show_progress: (boolean) If True, shows a progress bar. Default to True.
+        :return: numpy array of shape (n_sales, n_people) with the final wealth of each sale, with
+            people in the same order as the keys of the starting wealth
+        """
+        wealth = np.tile(self._start_w, (n_sales, 1))
+        people = np.tile(np.arange(self._n_people), (n_sales, 1))
+        for _ in tqdm(range(self.n), disable=not show_progress, mininterval=0.5):
+            self._rng.permuted(people, axis=1, out=people)
+            pair_idx = people.reshape(n_sales, -1, 2)
+            rolls_u = self._rng.random(pair_idx.shape[:2], dtype=np.float32)
+            _batch_sale_step(wealth, pair_idx, rolls_u,
+                             self.win_percentage, self.chi, self.zeta, self.kappa)
+        return wealth / 100
@@ -0,0 +1,91 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from helper import Wealth
+
+
+def _sale_step(w, key, win_percentage, chi, zeta, kappa):
+    """Returns the wealth after a single iteration of the extended yard sale model.
+
+    :param w: jax array of wealth in cents
+    :param key: jax PRNG key for this iteration
+    :param win_percentage: (float) Percentage of the poorer person's wealth that is exchanged
+    :param chi: (float) Wealth tax rate
+    :param zeta: (float) Bias in favour of the richer person
+    :param kappa: (float) Proportional to the amount of negative wealth a person can have
+    :return: jax array
+    """
+    pair_key, roll_key = jax.random.split(key)
+    avg_wealth = w.mean()
+
+    # People richer than the average pay the tax, which is shared equally by everyone else
+    rich = w > avg_wealth
+    tax = jnp.floor(chi * jnp.where(rich, w, 0).sum())
+    per_person_subsidy = jnp.round(tax / (w.size - rich.sum()))
+    w = jnp.where(rich, w - jnp.round(w * chi), w + per_person_subsidy).astype(jnp.int64)
+
+    loan = kappa * avg_wealth
+    pair_idx = jax.random.permutation(pair_key, w.size).reshape(-1, 2)
+    a, b = pair_idx[:, 0], pair_idx[:, 1]
+    wealth_a, wealth_b = w[a], w[b]
+    # The bias is defined on the wealth difference in dollars
+    bias = zeta * jnp.abs(wealth_a - wealth_b) / 100
+    poor_wins = jax.random.uniform(roll_key, a.shape) < 0.5 / (1 + bias)
+    exchange_amount = jnp.round((jnp.minimum(wealth_a, wealth_b) + loan) * win_percentage)
+    exchange_amount = jnp.where(poor_wins, exchange_amount, -exchange_amount).astype(jnp.int64)
+    # On a tie the first person of the pair is treated as the poorer one
+    delta_a = jnp.where(wealth_a <= wealth_b, exchange_amount, -exchange_amount)
+
+    # The loan is repaid in full, so only the exchanged cents change hands
+    return w.at[a].add(delta_a).at[b].add(-delta_a)
+
+
+@partial(jax.jit, static_argnames='n')
+def _run_sales(start_w, keys, n, win_percentage, chi, zeta, kappa):
+    """Returns the final wealth of one yard sale of n iterations per PRNG key.
+
+    :return: jax array of shape (number of keys, n_people)
+    """
+    def run_sale(key):
+        def step(w, step_key):
+            return _sale_step(w, step_key, win_percentage, chi, zeta, kappa), None
+
+        w, _ = jax.lax.scan(step, start_w, jax.random.split(key, n))
+        return w
+
+    return jax.vmap(run_sale)(keys)
+
+
+def run_multiple_sales(start_wealth,
+                       win_percentage,
+                       chi=0,
+                       zeta=0,
+                       kappa=0,
+                       n=10000,
+                       n_sales=100,
+                       seed=0):
+    """Runs independent extended yard sales with JAX, on a GPU or TPU when one is available.
+
+    Takes the same arguments as ExtendedYardSale. The n iterations are compiled into a single
+    scan and vectorized over the independent sales.
+
+    :param n_sales: (int) The number of independent yard sales. Default to 100.
+    :return: numpy array of shape (n_sales, n_people) with the final wealth of each sale, with
+        people in the same order as the keys of start_wealth
+    """
+    Wealth._validate_wealth(start_wealth)
+    wealth_values = np.fromiter(start_wealth.values(), dtype=np.float64, count=len(start_wealth))
+    # Wealth is held in int64 cents, as in the numpy implementation, which JAX only supports with
+    # x64. It is enabled for this call only so other JAX code keeps its default dtypes.
+    x64_enabled = jax.config.jax_enable_x64
+    jax.config.update('jax_enable_x64', True)
+    try:
+        start_w = jnp.asarray(np.round(wealth_values * 100).astype(np.int64))
+        keys = jax.random.split(jax.random.PRNGKey(seed), n_sales)
+        wealth = _run_sales(start_w, keys, n, win_percentage, chi, zeta, kappa)
+        return np.asarray(wealth) / 100
+    finally:
+        jax.config.update('jax_enable_x64', x64_enabled)